@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from torch import nn, optim
 from torch.distributions.normal import Normal
@@ -8,6 +9,15 @@ from networks import *
 from copy import deepcopy
 from tqdm import tqdm
 
+class WorldModelRollout(nn.Module):
+    """ Wraps the posterior rollout of the transition model as a module returning a tuple, as torch.cuda.make_graphed_callables requires """
+    def __init__(self, transition_model):
+        super().__init__()
+        self.transition_model = transition_model
+
+    def forward(self, prev_state, actions, prev_belief, observations, nonterminals):
+        return tuple(self.transition_model(prev_state, actions, prev_belief, observations, nonterminals))
+
 class Dreamer():
 
     def __init__(self, args):
@@ -19,13 +29,16 @@ class Dreamer():
         self.args = args
 
         # Initialize model parameters randomly
-        self.transition_model = TransitionModel(
+        # The transition model is scripted so its sequential rollout loop runs in the TorchScript interpreter; the scripted
+        # module shares its parameters with the eager one, which is kept for CUDA graph capture
+        transition_model = TransitionModel(
            args.belief_size,
            args.state_size,
            args.action_size,
            args.hidden_size,
            args.embedding_size,
            args.dense_act).to(device=args.device)
+        self.transition_model = torch.jit.script(transition_model)
 
         self.observation_model = ObservationModel(
            args.observation_size,
@@ -40,9 +53,7 @@ class Dreamer():
             args.hidden_size,
             args.dense_act).to(device=args.device)
         
-        self.encoder = Encoder(
-            args.observation_size,
-            args.embedding_size).to(device=args.device)
+        self.encoder = self._make_encoder().to(device=args.device)
         
         self.actor_model = ActorModel(
             args.action_size,
@@ -50,6 +61,9 @@ class Dreamer():
             args.state_size,
             args.hidden_size,
             activation_function=args.dense_act).to(device=args.device)
+        # Scripted view of the actor used to act in the environment (it shares parameters with actor_model), so the
+        # dense stack and sampling run in the TorchScript interpreter, where the fuser can merge the elementwise ops
+        self.inference_actor = torch.jit.script(self.actor_model)
         
         self.value_model = ValueModel(
             args.belief_size,
@@ -67,6 +81,13 @@ class Dreamer():
         for p in self.target_value_model.parameters():
             p.requires_grad = False
 
+        if args.compile:
+            # compile the dense models in place (state_dict keys are unchanged); on CUDA, reduce-overhead also
+            # captures each compiled forward as a CUDA graph to remove the per-layer kernel launch overhead
+            for model in (self.observation_model, self.reward_model, self.encoder, self.actor_model,
+                          self.value_model, self.target_value_model, self.pcont_model):
+                model.compile(mode='reduce-overhead', fullgraph=True)
+
         # setup the paras to update
         self.world_param = list(self.transition_model.parameters())\
                         + list(self.observation_model.parameters())\
@@ -83,8 +104,44 @@ class Dreamer():
 
         # setup the free_nat
         self.free_nats = torch.full((1, ), args.free_nats, dtype=torch.float32, device=args.device) # allowed deviation in KL divergence
+
+        # With --cuda-graph, the world-model rollout (forward and backward) is captured once as a CUDA graph and replayed at every
+        # update instead of launching each kernel of the sequential loop; the training batches have static shapes.
+        # The eager module is captured rather than the scripted one, and the autocast weight cache is disabled around
+        # capture and replay, as CUDA graphs require
+        self.graphed_transition = None
+        if args.cuda_graph and args.device.type == 'cuda':
+            # the observation embeddings are captured in the dtype the encoder produces under autocast (bf16 with --amp)
+            with torch.no_grad(), self._autocast():
+                embedding_dtype = self.encoder(torch.zeros(1, args.observation_size, device=args.device)).dtype
+            sample_args = (torch.zeros(args.batch_size, args.state_size, device=args.device),
+                           torch.zeros(args.sequence_length, args.batch_size, args.action_size, device=args.device),
+                           torch.zeros(args.batch_size, args.belief_size, device=args.device),
+                           torch.zeros(args.sequence_length, args.batch_size, args.embedding_size, dtype=embedding_dtype, device=args.device, requires_grad=True),
+                           torch.ones(args.sequence_length, args.batch_size, 1, device=args.device))
+            with self._autocast(cache_enabled=False):
+                self.graphed_transition = torch.cuda.make_graphed_callables(WorldModelRollout(transition_model), sample_args)
+
+        # With --quantize, environment rollouts on CPU encode observations with an int8 dynamically quantized copy of the
+        # encoder; training keeps the FP32 encoder
+        self.inference_encoder = None
+        self.quantize_encoder()
         
 
+    def _make_encoder(self):
+        # single place for the Encoder constructor args, shared by the training encoder and its int8 inference copy
+        return Encoder(
+            self.args.observation_size,
+            self.args.embedding_size)
+
+    def quantize_encoder(self):
+        # (re)build the int8 inference encoder from the current FP32 weights; dynamic quantization only runs on CPU
+        if not self.args.quantize or self.args.device.type != 'cpu':
+            return
+        encoder = self._make_encoder()
+        encoder.load_state_dict(self.encoder.state_dict())
+        self.inference_encoder = torch.ao.quantization.quantize_dynamic(encoder, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
     def replace_target_network(self):
         with torch.no_grad():
             for param, target_param in zip(self.value_model.parameters(), 
@@ -95,7 +152,7 @@ class Dreamer():
     def select_action(self, state, deterministic=False):
         # get action with the inputs get from fn: infer_state; return a numpy with shape [batch, act_size]
         belief, posterior_state = state
-        action, _ = self.actor_model(belief, posterior_state, deterministic=deterministic, with_logprob=False)
+        action, _ = self.inference_actor(belief, posterior_state, deterministic=deterministic, with_logprob=False)
 
         if not deterministic and not self.args.with_logprob: ## add exploration noise
             action = Normal(action, self.args.expl_amount).rsample()
@@ -220,6 +277,11 @@ class Dreamer():
 
         return imag_beliefs, imag_states, imag_ac_logps if with_logprob else None
 
+    def _autocast(self, cache_enabled=True):
+        # bf16 autocast for the forward passes and losses (no-op unless --amp); backward and optimizer steps stay outside.
+        # The weight cache is only disabled around CUDA graph capture and replay, which do not support it
+        return torch.autocast(device_type=self.args.device.type, dtype=torch.bfloat16, enabled=self.args.amp, cache_enabled=cache_enabled)
+
     def update_parameters(self, data, gradient_steps):
         loss_info = []  # used to record loss
         for s in tqdm(range(gradient_steps)): # collect interval
@@ -229,19 +291,23 @@ class Dreamer():
             init_belief = torch.zeros(self.args.batch_size, self.args.belief_size, device=self.args.device)
             init_state = torch.zeros(self.args.batch_size, self.args.state_size, device=self.args.device)
 
-            # Update belief/state using posterior from previous belief/state, previous action and current observation (over entire sequence at once)
-            beliefs, prior_states, prior_means, prior_std_devs, posterior_states, posterior_means, posterior_std_devs = self.transition_model(
-                init_state,
-                actions,
-                init_belief,
-                bottle(self.encoder, (observations, )),
-                nonterminals)  # TODO: 4
-
-            # update paras of world model
-            world_model_loss = self._compute_loss_world(
-                state=(beliefs, prior_states, prior_means, prior_std_devs, posterior_states, posterior_means, posterior_std_devs),
-                data=(observations, rewards, nonterminals)
-            )
+            transition_model = self.transition_model if self.graphed_transition is None else self.graphed_transition
+            with self._autocast():
+                embedded_observations = bottle(self.encoder, (observations, ))
+                with self._autocast(cache_enabled=self.graphed_transition is None):
+                    # Update belief/state using posterior from previous belief/state, previous action and current observation (over entire sequence at once)
+                    beliefs, prior_states, prior_means, prior_std_devs, posterior_states, posterior_means, posterior_std_devs = transition_model(
+                        init_state,
+                        actions,
+                        init_belief,
+                        embedded_observations,
+                        nonterminals)  # TODO: 4
+
+                # update paras of world model
+                world_model_loss = self._compute_loss_world(
+                    state=(beliefs, prior_states, prior_means, prior_std_devs, posterior_states, posterior_means, posterior_std_devs),
+                    data=(observations, rewards, nonterminals)
+                )
             observation_loss, reward_loss, kl_loss, pcont_loss = world_model_loss
             self. world_optimizer.zero_grad()
             (observation_loss + reward_loss + kl_loss + pcont_loss).backward()
@@ -254,11 +320,12 @@ class Dreamer():
             for p in self.value_model.parameters():
                 p.requires_grad = False
 
-            # latent imagination
-            imag_beliefs, imag_states, imag_ac_logps = self._latent_imagination(beliefs, posterior_states, with_logprob=self.args.with_logprob)
+            with self._autocast():
+                # latent imagination
+                imag_beliefs, imag_states, imag_ac_logps = self._latent_imagination(beliefs, posterior_states, with_logprob=self.args.with_logprob)
 
-            # update actor
-            actor_loss = self._compute_loss_actor(imag_beliefs, imag_states, imag_ac_logps=imag_ac_logps)
+                # update actor
+                actor_loss = self._compute_loss_actor(imag_beliefs, imag_states, imag_ac_logps=imag_ac_logps)
 
             self.actor_optimizer.zero_grad()
             actor_loss.backward()
@@ -274,7 +341,8 @@ class Dreamer():
             imag_beliefs = imag_beliefs.detach()
             imag_states = imag_states.detach()
 
-            critic_loss = self._compute_loss_critic(imag_beliefs, imag_states, imag_ac_logps=imag_ac_logps)
+            with self._autocast():
+                critic_loss = self._compute_loss_critic(imag_beliefs, imag_states, imag_ac_logps=imag_ac_logps)
 
             self.value_optimizer.zero_grad()
             critic_loss.backward()
@@ -286,6 +354,7 @@ class Dreamer():
         # finally, update target value function every #gradient_steps
         with torch.no_grad():
             self.target_value_model.load_state_dict(self.value_model.state_dict())
+        self.quantize_encoder()
 
         return loss_info
     
@@ -295,11 +364,12 @@ class Dreamer():
             returned shape: belief/state [belief/state_dim] (remove the time_dim)
         """
         # observation is obs.to(device), action.shape=[act_dim] (will add time dim inside this fn), belief.shape
+        encoder = self.encoder if self.inference_encoder is None else self.inference_encoder
         belief, _, _, _, posterior_state, _, _ = self.transition_model(
                                                 state,
                                                 action.unsqueeze(dim=0),
                                                 belief,
-                                                self.encoder(observation).unsqueeze(dim=0))  # Action and observation need extra time dimension
+                                                encoder(observation).unsqueeze(dim=0))  # Action and observation need extra time dimension
 
         belief, posterior_state = belief.squeeze(dim=0), posterior_state.squeeze(dim=0)  # Remove time dimension from belief/state
 
@@ -1,22 +1,53 @@
-from typing import Optional, List
+import math
+from typing import Optional, List, Tuple, Final
 
 import torch 
 import torch.nn as nn
 import torch.nn.functional as F
 
-import numpy as np
-
 
 # Wraps the input tuple for a function to process a time x batch x features sequence in batch x features (assumes one output)
 def bottle(f, x_tuple):
-  x_sizes = tuple(map(lambda x: x.size(), x_tuple))
-  y = f(*map(lambda x: x[0].view(x[1][0] * x[1][1], *x[1][2:]), zip(x_tuple, x_sizes)))
-  y_size = y.size()
-  output = y.view(x_sizes[0][0], x_sizes[0][1], *y_size[1:])
-  return output
+  T, B = x_tuple[0].shape[:2]
+  y = f(*[x.flatten(0, 1) for x in x_tuple])
+  return y.unflatten(0, (T, B))
+
+
+# Applies a linear layer to torch.cat([belief, state], dim=-1) as two matmuls, without materializing the concatenation
+def linear_cat(weight: torch.Tensor, bias: torch.Tensor, belief: torch.Tensor, state: torch.Tensor) -> torch.Tensor:
+  belief_size = belief.size(-1)
+  return F.linear(belief, weight[:, :belief_size], bias) + F.linear(state, weight[:, belief_size:])
+
+
+# Upcasts reduced-precision outputs (bf16 under autocast) to FP32 and leaves FP32 and FP64 tensors unchanged
+def at_least_fp32(x: torch.Tensor) -> torch.Tensor:
+  return x.to(torch.promote_types(x.dtype, torch.float32))
+
+
+# Reparameterized Normal sample mean + std_dev * noise with std_dev = softplus(raw_std_dev + std_offset) + min_std_dev (computed in
+# at least FP32). Scripted so that the elementwise chain can be fused into a single kernel by the TorchScript fuser
+@torch.jit.script
+def reparameterize(mean: torch.Tensor, raw_std_dev: torch.Tensor, noise: torch.Tensor, std_offset: float, min_std_dev: float) -> Tuple[torch.Tensor, torch.Tensor]:
+  std_dev = F.softplus(at_least_fp32(raw_std_dev) + std_offset) + min_std_dev
+  return mean + std_dev * noise, std_dev
+
+
+# Same computation as nn.GRUCell (gates ordered r, z, n), written out so that the gate nonlinearities and the state update
+# form a single elementwise chain that the TorchScript fuser can merge into one kernel instead of dispatching each op
+@torch.jit.script
+def gru_cell(input: torch.Tensor, hidden: torch.Tensor, w_ih: torch.Tensor, w_hh: torch.Tensor, b_ih: torch.Tensor, b_hh: torch.Tensor) -> torch.Tensor:
+  gi = torch.addmm(b_ih, input, w_ih.t())
+  gh = torch.addmm(b_hh, hidden, w_hh.t())
+  i_r, i_z, i_n = gi.chunk(3, 1)
+  h_r, h_z, h_n = gh.chunk(3, 1)
+  r = torch.sigmoid(i_r + h_r)
+  z = torch.sigmoid(i_z + h_z)
+  n = torch.tanh(i_n + r * h_n)
+  return (1 - z) * n + z * hidden
 
     
 class TransitionModel(nn.Module):
+    min_std_dev: Final[float]  # constant-folded when the module is scripted
 
     def __init__(self, belief_size, dim_states, dim_actions, hidden_size, embedding_size, activation_function='relu', min_std_dev=0.1):
         super(TransitionModel, self).__init__()
@@ -25,7 +56,7 @@ class TransitionModel(nn.Module):
 
         # deterministic state model:
         self.fc_embed_state_action = nn.Linear(dim_states + dim_actions, belief_size)
-        self.rnn = nn.GRUCell(belief_size, belief_size)
+        self.rnn = nn.GRUCell(belief_size, belief_size)  # holds the parameters, applied with gru_cell in forward
 
         # stochastic state model
         self.fc_embed_belief_prior = nn.Linear(belief_size, hidden_size)
@@ -33,12 +64,6 @@ class TransitionModel(nn.Module):
 
         self.fc_embed_belief_posterior = nn.Linear(belief_size + embedding_size, hidden_size)
         self.fc_state_posterior = nn.Linear(hidden_size, 2 * dim_states)
-        
-        self.modules = [self.fc_embed_state_action,
-                        self.fc_embed_belief_prior,
-                        self.fc_state_prior,
-                        self.fc_embed_belief_posterior,
-                        self.fc_state_posterior]
 
 
     def forward(self, prev_state:torch.Tensor, actions:torch.Tensor, prev_belief:torch.Tensor, observations:Optional[torch.Tensor]=None, nonterminals:Optional[torch.Tensor]=None) -> List[torch.Tensor]:
@@ -48,36 +73,71 @@ class TransitionModel(nn.Module):
                 torch.Size([49, 50, 200]) torch.Size([49, 50, 30]) torch.Size([49, 50, 30]) torch.Size([49, 50, 30]) torch.Size([49, 50, 30]) torch.Size([49, 50, 30]) torch.Size([49, 50, 30])
         '''
         # Create lists for hidden states (cannot use single tensor as buffer because autograd won't work with inplace writes)
+        # Lists are typed and grown with append() so the loop can run inside the TorchScript interpreter. With observations,
+        # each step appends the stacked [prior, posterior] tensors, so every output is produced by one stack at the end
         T = actions.size(0) + 1 # sequence_length in the example
-        beliefs, prior_states, prior_means, prior_std_devs, posterior_states, posterior_means, posterior_std_devs = [torch.empty(0)] * T, [torch.empty(0)] * T, [torch.empty(0)] * T, [torch.empty(0)] * T, [torch.empty(0)] * T, [torch.empty(0)] * T, [torch.empty(0)] * T
-        beliefs[0], prior_states[0], posterior_states[0] = prev_belief, prev_state, prev_state
+        beliefs: List[torch.Tensor] = []
+        states: List[torch.Tensor] = []
+        means: List[torch.Tensor] = []
+        std_devs: List[torch.Tensor] = []
+        belief, state = prev_belief, prev_state
+        # The action half of fc_embed_state_action does not depend on the recurrent state, so it is projected for
+        # all timesteps with one batched matmul and only the state half is left inside the loop
+        dim_states = prev_state.size(1)
+        embed_state_weight = self.fc_embed_state_action.weight[:, :dim_states]
+        embedded_actions = F.linear(actions, self.fc_embed_state_action.weight[:, dim_states:], self.fc_embed_state_action.bias)
+        if observations is not None:
+            # Stack the prior and posterior heads so that both run as one GEMM per layer inside the loop. The observation
+            # columns of the posterior embedding (and both biases) are loop-invariant, so they are applied to the whole
+            # observation sequence at once; the prior does not read observations, hence the zero padding of its half
+            belief_size = prev_belief.size(1)
+            embed_belief_weight = torch.cat([self.fc_embed_belief_prior.weight, self.fc_embed_belief_posterior.weight[:, :belief_size]], dim=0)
+            embed_bias = torch.cat([self.fc_embed_belief_prior.bias, self.fc_embed_belief_posterior.bias], dim=0)
+            embedded_observations = F.pad(F.linear(observations, self.fc_embed_belief_posterior.weight[:, belief_size:]), (self.fc_embed_belief_prior.out_features, 0)) + embed_bias
+            # Gaussian noise of the whole trajectory is drawn up front with one RNG call instead of one per step
+            noise = torch.randn(T - 1, 2, prev_state.size(0), dim_states, dtype=prev_state.dtype, device=prev_state.device)
+            state_weight = torch.stack([self.fc_state_prior.weight, self.fc_state_posterior.weight], dim=0).transpose(1, 2)
+            state_bias = torch.stack([self.fc_state_prior.bias, self.fc_state_posterior.bias], dim=0).unsqueeze(1)
+        else:
+            embed_belief_weight, embedded_observations, state_weight, state_bias = torch.empty(0), torch.empty(0), torch.empty(0), torch.empty(0)
+            noise = torch.randn(T - 1, prev_state.size(0), dim_states, dtype=prev_state.dtype, device=prev_state.device)
         # Loop over time sequence
         for t in range(T - 1):
-            _state = prior_states[t] if (observations is None) else posterior_states[t]  # Select appropriate previous state
-            _state = _state if (nonterminals is None or t == 0) else _state * nonterminals[t-1]  # Mask if previous transition was terminal
+            _state = state  # previous prior state, or previous posterior state when observations are given
+            if nonterminals is not None and t != 0:
+                _state = _state * nonterminals[t-1]  # Mask if previous transition was terminal
             # Compute belief (deterministic hidden state)
-            hidden = self.act_fn(self.fc_embed_state_action(torch.cat([_state, actions[t]], dim=1)))
-            beliefs[t + 1] = self.rnn(hidden, beliefs[t])
-            
-            # Compute state prior by applying transition dynamics
-            hidden = self.act_fn(self.fc_embed_belief_prior(beliefs[t + 1]))
-            prior_means[t + 1], _prior_std_dev = torch.chunk(self.fc_state_prior(hidden), 2, dim=1)
-            prior_std_devs[t + 1] = F.softplus(_prior_std_dev) + self.min_std_dev # constraint std_devs to be positive
-            prior_states[t + 1] = prior_means[t + 1] + prior_std_devs[t + 1] * torch.randn_like(prior_means[t + 1])
+            hidden = self.act_fn(F.linear(_state, embed_state_weight) + embedded_actions[t])
+            belief = gru_cell(hidden, belief, self.rnn.weight_ih, self.rnn.weight_hh, self.rnn.bias_ih, self.rnn.bias_hh)
+            beliefs.append(belief)
             
-            if observations is not None:
-                # Compute state posterior by applying transition dynamics and using current observation
-                t_ = t - 1  # Use t_ to deal with different time indexing for observations
-                hidden = self.act_fn(self.fc_embed_belief_posterior(torch.cat([beliefs[t + 1], observations[t_ + 1]], dim=1)))
-                posterior_means[t + 1], _posterior_std_dev = torch.chunk(self.fc_state_posterior(hidden), 2, dim=1)
-                posterior_std_devs[t + 1] = F.softplus(_posterior_std_dev) + self.min_std_dev
-                posterior_states[t + 1] = posterior_means[t + 1] + posterior_std_devs[t + 1] * torch.randn_like(posterior_means[t + 1])
+            if observations is None:
+                # Compute state prior by applying transition dynamics
+                hidden = self.act_fn(self.fc_embed_belief_prior(belief))
+                mean, _std_dev = torch.chunk(at_least_fp32(self.fc_state_prior(hidden)), 2, dim=1)  # means and std_devs in FP32 under autocast
+                state, std_dev = reparameterize(mean, _std_dev, noise[t], 0., self.min_std_dev) # constraint std_devs to be positive
+                means.append(mean)
+                std_devs.append(std_dev)
+                states.append(state)
+            else:
+                # Compute state prior (transition dynamics) and posterior (also using current observation) together
+                hidden = self.act_fn(F.linear(belief, embed_belief_weight) + embedded_observations[t])
+                hidden = hidden.view(hidden.size(0), 2, -1).transpose(0, 1)  # [prior, posterior] x batch x hidden
+                mean, _std_dev = torch.chunk(at_least_fp32(torch.baddbmm(state_bias, hidden, state_weight)), 2, dim=2)  # means and std_devs in FP32 under autocast
+                sample, std_dev = reparameterize(mean, _std_dev, noise[t], 0., self.min_std_dev) # constraint std_devs to be positive
+                state = sample[1]
+                means.append(mean)
+                std_devs.append(std_dev)
+                states.append(sample)
         
         # Return new hidden states
-        hidden = [torch.stack(beliefs[1:], dim=0), torch.stack(prior_states[1:], dim=0), torch.stack(prior_means[1:], dim=0), torch.stack(prior_std_devs[1:], dim=0)]
-        if observations is not None:
-            hidden += [torch.stack(posterior_states[1:], dim=0), torch.stack(posterior_means[1:], dim=0), torch.stack(posterior_std_devs[1:], dim=0)]
-        return hidden
+        if observations is None:
+            return [torch.stack(beliefs, dim=0), torch.stack(states, dim=0), torch.stack(means, dim=0), torch.stack(std_devs, dim=0)]
+        # Stacking along dim 1 gives [prior/posterior] x time x batch x features, so unbind(0) returns contiguous tensors
+        prior_states, posterior_states = torch.stack(states, dim=1).unbind(0)
+        prior_means, posterior_means = torch.stack(means, dim=1).unbind(0)
+        prior_std_devs, posterior_std_devs = torch.stack(std_devs, dim=1).unbind(0)
+        return [torch.stack(beliefs, dim=0), prior_states, prior_means, prior_std_devs, posterior_states, posterior_means, posterior_std_devs]
     
 class Encoder(nn.Module):
     '''
@@ -105,7 +165,7 @@ class ObservationModel(nn.Module):
         self.fc3 = nn.Linear(embedding_size, observation_size)
 
     def forward(self, belief, state):
-        hidden = self.act_fn(self.fc1(torch.cat([belief, state], dim=1)))
+        hidden = self.act_fn(linear_cat(self.fc1.weight, self.fc1.bias, belief, state))
         hidden = self.act_fn(self.fc2(hidden))
         observation = self.fc3(hidden)
         return observation
@@ -119,10 +179,9 @@ class RewardModel(nn.Module):
         self.fc3 = nn.Linear(hidden_size, 1)
 
     def forward(self, belief, state):
-        x = torch.cat([belief, state],dim=1)
-        hidden = self.act_fn(self.fc1(x))
+        hidden = self.act_fn(linear_cat(self.fc1.weight, self.fc1.bias, belief, state))
         hidden = self.act_fn(self.fc2(hidden))
-        reward = self.fc3(hidden)
+        reward = at_least_fp32(self.fc3(hidden))  # rewards feed the lambda-returns, kept in FP32 under autocast
         reward = reward.squeeze(dim=-1)
         return reward
 
@@ -136,15 +195,18 @@ class ValueModel(nn.Module):
         self.fc4 = nn.Linear(hidden_size, 1)
 
     def forward(self, belief, state):
-        x = torch.cat([belief, state],dim=1)
-        hidden = self.act_fn(self.fc1(x))
+        hidden = self.act_fn(linear_cat(self.fc1.weight, self.fc1.bias, belief, state))
         hidden = self.act_fn(self.fc2(hidden))
         hidden = self.act_fn(self.fc3(hidden))
-        reward = self.fc4(hidden).squeeze(dim=1)
+        reward = at_least_fp32(self.fc4(hidden)).squeeze(dim=1)  # values feed the lambda-returns, kept in FP32 under autocast
         return reward
 
 
 class ActorModel(nn.Module):
+  mean_scale: Final[float]
+  min_std: Final[float]
+  raw_init_std: Final[float]
+
   def __init__(self, action_size, belief_size, state_size, hidden_size, mean_scale=5, min_std=1e-4, init_std=5, activation_function="elu"):
     super().__init__()
     self.act_fn = getattr(F, activation_function)
@@ -153,41 +215,52 @@ class ActorModel(nn.Module):
     self.fc3 = nn.Linear(hidden_size, hidden_size)
     self.fc4 = nn.Linear(hidden_size, hidden_size)
     self.fc5 = nn.Linear(hidden_size, 2 * action_size)
-    self.min_std = min_std
+    self.min_std = float(min_std)
     self.init_std = init_std
-    self.mean_scale = mean_scale
+    self.raw_init_std = math.log(math.expm1(init_std))  # softplus^-1(init_std), constant so computed once here
+    self.mean_scale = float(mean_scale)
 
-  def forward(self, belief, state, deterministic=False, with_logprob=False):
-    raw_init_std = np.log(np.exp(self.init_std) - 1)
-    hidden = self.act_fn(self.fc1(torch.cat([belief, state], dim=-1)))
+  def forward(self, belief: torch.Tensor, state: torch.Tensor, deterministic: bool=False, with_logprob: bool=False) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    hidden = self.act_fn(linear_cat(self.fc1.weight, self.fc1.bias, belief, state))
     hidden = self.act_fn(self.fc2(hidden))
     hidden = self.act_fn(self.fc3(hidden))
     hidden = self.act_fn(self.fc4(hidden))
-    hidden = self.fc5(hidden)
-    mean, std = torch.chunk(hidden, 2, dim=-1) 
+    mean, std = torch.chunk(at_least_fp32(self.fc5(hidden)), 2, dim=-1)  # keep the tanh squash and log-prob in FP32 under autocast
     mean = self.mean_scale * torch.tanh(mean / self.mean_scale)  # bound the action to [-5, 5] --> to avoid numerical instabilities.  For computing log-probabilities, we need to invert the tanh and this becomes difficult in highly saturated regions.
-    std = F.softplus(std + raw_init_std) + self.min_std
-    dist = torch.distributions.Normal(mean, std)
-    transform = [torch.distributions.transforms.TanhTransform()]
-    dist = torch.distributions.TransformedDistribution(dist, transform)
-    dist = torch.distributions.independent.Independent(dist, 1)  # Introduces dependence between actions dimension
-    dist = SampleDist(dist)  # because after transform a distribution, some methods may become invalid, such as entropy, mean and mode, we need SmapleDist to approximate it.
 
     if deterministic:
-      action = dist.mean
-    else:
-      action = dist.rsample()
+      return self._sampled_mean(mean, F.softplus(std + self.raw_init_std) + self.min_std, with_logprob)
+
+    # reparameterized sample of the tanh-squashed Normal, written out instead of going through torch.distributions
+    noise = torch.randn_like(mean)
+    pre_tanh_action, std = reparameterize(mean, std, noise, self.raw_init_std, self.min_std)
+    action = torch.tanh(pre_tanh_action)
 
+    logp_pi: Optional[torch.Tensor] = None
     if with_logprob:
-      logp_pi = dist.log_prob(action)
-    else:
-      logp_pi = None
+      # Normal log-prob of the pre-tanh sample minus log|det J| of tanh, 2 * (log(2) - x - softplus(-2x)), summed over action dims
+      logp_pi = (-0.5 * noise.pow(2) - std.log() - 0.5 * math.log(2 * math.pi)).sum(dim=-1) \
+                - (2 * (math.log(2.) - pre_tanh_action - F.softplus(-2 * pre_tanh_action))).sum(dim=-1)
 
     return action, logp_pi
+
+  @torch.jit.ignore
+  def _sampled_mean(self, mean: torch.Tensor, std: torch.Tensor, with_logprob: bool) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    # the mean of a tanh-squashed Normal has no closed form, so it is estimated by sampling (evaluation only);
+    # torch.distributions is not scriptable, so this always runs in Python
+    dist = torch.distributions.Normal(mean, std)
+    dist = torch.distributions.TransformedDistribution(dist, torch.distributions.transforms.TanhTransform())
+    dist = torch.distributions.independent.Independent(dist, 1)  # Introduces dependence between actions dimension
+    dist = SampleDist(dist)  # because after transform a distribution, some methods may become invalid, such as entropy, mean and mode, we need SmapleDist to approximate it.
+    action = dist.mean
+    logp_pi = dist.log_prob(action) if with_logprob else None
+    return action, logp_pi
   
 class SampleDist:
   """
   After TransformedDistribution, many methods becomes invalid, therefore, we need to approximate them.
+  mean works for any distribution with rsample; mode and entropy only support
+  Independent(TransformedDistribution(base, elementwise transforms), 1), as built by ActorModel.
   """
   def __init__(self, dist: torch.distributions.Distribution, samples=100):
     self._dist = dist
@@ -202,26 +275,37 @@ class SampleDist:
 
   @property
   def mean(self):
-    dist = self._dist.expand((self._samples, *self._dist.batch_shape))
-    sample = dist.rsample()
+    sample = self._dist.rsample((self._samples,))
     return torch.mean(sample, 0)
 
+  def _rsample_through_transforms(self):
+    # Samples the base Normal of Independent(TransformedDistribution(Normal, transforms)) and pushes it through the
+    # transforms, accumulating log|det J| from the pre-transform values (closed form for tanh) instead of inverting
+    # the transformed sample, which is unstable where tanh saturates
+    transformed = getattr(self._dist, 'base_dist', None)
+    if not (isinstance(self._dist, torch.distributions.Independent) and self._dist.reinterpreted_batch_ndims == 1
+            and isinstance(transformed, torch.distributions.TransformedDistribution)
+            and all(transform.domain.event_dim == 0 for transform in transformed.transforms)):
+      raise NotImplementedError('SampleDist.mode/entropy expect Independent(TransformedDistribution(base, elementwise transforms), 1), got {}'.format(self._dist))
+    base_sample = transformed.base_dist.rsample((self._samples,))
+    sample, log_det = base_sample, torch.zeros_like(base_sample)
+    for transform in transformed.transforms:
+      next_sample = transform(sample)
+      log_det = log_det + transform.log_abs_det_jacobian(sample, next_sample)
+      sample = next_sample
+    return base_sample, sample, log_det
+
   def mode(self):
-    dist = self._dist.expand((self._samples, *self._dist.batch_shape))
-    sample = dist.rsample()
-    # print("dist in mode", sample.shape)
-    logprob = dist.log_prob(sample)
-    batch_size = sample.size(1)
-    feature_size = sample.size(2)
-    indices = torch.argmax(logprob, dim=0).reshape(1, batch_size, 1).expand(1, batch_size, feature_size)
-    return torch.gather(sample, 0, indices).squeeze(0)
+    base_sample, sample, log_det = self._rsample_through_transforms()
+    logprob = (self._dist.base_dist.base_dist.log_prob(base_sample) - log_det).sum(dim=-1)
+    indices = torch.argmax(logprob, dim=0)
+    return sample[indices, torch.arange(sample.size(1), device=sample.device)]
 
   def entropy(self):
-    dist = self._dist.expand((self._samples, *self._dist.batch_shape))
-    sample = dist.rsample()
-    logprob = dist.log_prob(sample)
-    return -torch.mean(logprob, 0)
-
+    # H[f(X)] = H[X] + E[log|det J_f(X)|]: the base entropy is exact, only the log-det term is estimated by sampling
+    _, _, log_det = self._rsample_through_transforms()
+    entropy = self._dist.base_dist.base_dist.entropy() + torch.mean(log_det, 0)
+    return entropy.sum(dim=-1)
 
 class PCONTModel(nn.Module):
   """ predict the prob of whether a state is a terminal state. """
@@ -234,10 +318,9 @@ class PCONTModel(nn.Module):
     self.fc4 = nn.Linear(hidden_size, 1)
 
   def forward(self, belief, state):
-    x = torch.cat([belief, state],dim=1)
-    hidden = self.act_fn(self.fc1(x))
+    hidden = self.act_fn(linear_cat(self.fc1.weight, self.fc1.bias, belief, state))
     hidden = self.act_fn(self.fc2(hidden))
     hidden = self.act_fn(self.fc3(hidden))
-    x = self.fc4(hidden).squeeze(dim=1)
+    x = at_least_fp32(self.fc4(hidden)).squeeze(dim=1)  # discounts feed the lambda-returns, kept in FP32 under autocast
     p = torch.sigmoid(x)
     return p
\ No newline at end of file
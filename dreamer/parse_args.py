@@ -44,6 +44,10 @@ def parse_args():
     parser.add_argument('--render', action='store_true', help='Render environment')
     parser.add_argument('--pcont', action='store_true', help="use the pcont to predict the continuity")
     parser.add_argument('--with_logprob', action='store_true', help='use the entropy regularization')
+    parser.add_argument('--compile', action='store_true', help='compile the dense models with torch.compile')
+    parser.add_argument('--amp', action='store_true', help='run the forward passes under bf16 autocast')
+    parser.add_argument('--cuda-graph', action='store_true', help='capture the world-model rollout as a CUDA graph')
+    parser.add_argument('--quantize', action='store_true', help='use an int8 quantized encoder for rollouts on CPU')
 
     args = parser.parse_args()
     
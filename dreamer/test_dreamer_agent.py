@@ -0,0 +1,72 @@
+import pytest
+import torch
+from networks import TransitionModel
+from dreamer_agent import WorldModelRollout
+from test_networks import BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE, no_noise, rollout_inputs, weighted_sum
+
+
+def cuda_rollout_inputs(embedding_dtype):
+    # observations come in the dtype the encoder produces under autocast, as in Dreamer.update_parameters
+    prev_state, actions, prev_belief, observations, nonterminals = [x.cuda() for x in rollout_inputs(with_observations=True)]
+    return prev_state, actions, prev_belief, observations.to(embedding_dtype).requires_grad_(), nonterminals
+
+
+def outputs_and_grads(rollout, model, inputs):
+    # runs the rollout with zero noise and returns its outputs with the gradients of the parameters and the observations
+    model.zero_grad()
+    inputs[3].grad = None
+    with no_noise():
+        outputs = rollout(*inputs)
+    weighted_sum(outputs).backward()
+    return outputs, [p.grad.clone() for p in model.parameters() if p.grad is not None] + [inputs[3].grad.clone()]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs need a GPU')
+def test_graphed_world_model_rollout():
+    # the replayed CUDA graph of the posterior rollout (as captured with --cuda-graph) matches the eager rollout, on
+    # inputs other than the ones it was captured with
+    for amp in (False, True):
+        torch.manual_seed(0)
+        model = TransitionModel(BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE, 'elu').cuda()
+        embedding_dtype = torch.bfloat16 if amp else torch.float32
+        autocast = lambda: torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=amp, cache_enabled=False)
+        with no_noise(), autocast():
+            graphed_rollout = torch.cuda.make_graphed_callables(WorldModelRollout(model), cuda_rollout_inputs(embedding_dtype))
+
+        inputs = cuda_rollout_inputs(embedding_dtype)
+        with autocast():
+            expected, expected_grads = outputs_and_grads(WorldModelRollout(model), model, inputs)
+            outputs, grads = outputs_and_grads(graphed_rollout, model, inputs)
+
+        atol = 1e-2 if amp else 1e-5
+        assert len(grads) == len(expected_grads), 'Graphed rollout does not reach the same parameters'
+        for output, expected_output in zip(outputs, expected):
+            assert torch.allclose(output.float(), expected_output.float(), atol=atol), 'Graphed rollout differs from eager'
+        for grad, expected_grad in zip(grads, expected_grads):
+            assert torch.allclose(grad.float(), expected_grad.float(), atol=atol), 'Graphed rollout gradient differs from eager'
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs need a GPU')
+def test_graphed_world_model_rollout_noise():
+    # captured with the real RNG, every replay draws fresh noise: the first beliefs do not depend on it, the states do
+    for amp in (False, True):
+        torch.manual_seed(0)
+        model = TransitionModel(BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE, 'elu').cuda()
+        embedding_dtype = torch.bfloat16 if amp else torch.float32
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=amp, cache_enabled=False):
+            graphed_rollout = torch.cuda.make_graphed_callables(WorldModelRollout(model), cuda_rollout_inputs(embedding_dtype))
+            inputs = cuda_rollout_inputs(embedding_dtype)
+            first = [output.detach().clone() for output in graphed_rollout(*inputs)]
+            second = [output.detach().clone() for output in graphed_rollout(*inputs)]
+
+        beliefs, prior_states, posterior_states = 0, 1, 4
+        assert torch.equal(first[beliefs][0], second[beliefs][0]), 'First belief should not depend on the noise'
+        assert not torch.equal(first[prior_states], second[prior_states]), 'Replays drew the same prior noise'
+        assert not torch.equal(first[posterior_states], second[posterior_states]), 'Replays drew the same posterior noise'
+
+
+if __name__ == '__main__':
+
+    test_graphed_world_model_rollout()
+    test_graphed_world_model_rollout_noise()
+    print('All tests passed')
@@ -0,0 +1,226 @@
+import math
+from unittest import mock
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+from networks import gru_cell, TransitionModel, ActorModel, RewardModel, ValueModel, PCONTModel, SampleDist
+
+BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE = 20, 5, 3, 16, 12
+T, BATCH_SIZE = 6, 4
+
+
+def no_noise():
+    # patches the Gaussian noise of the (eager) models to zero, so every sampled state equals its mean
+    return mock.patch.multiple(torch,
+                               randn=lambda *size, **kwargs: torch.zeros(*size, dtype=kwargs.get('dtype'), device=kwargs.get('device')),
+                               randn_like=lambda x, **kwargs: torch.zeros_like(x))
+
+
+def reference_rollout(model, prev_state, actions, prev_belief, observations, nonterminals):
+    # step by step rollout with nn.GRUCell, torch.cat and torch.chunk, as TransitionModel was first written (noise-free)
+    beliefs, prior_states, prior_means, prior_std_devs = [prev_belief], [prev_state], [], []
+    posterior_states, posterior_means, posterior_std_devs = [prev_state], [], []
+    for t in range(actions.size(0)):
+        state = prior_states[t] if observations is None else posterior_states[t]
+        state = state if t == 0 else state * nonterminals[t - 1]
+        hidden = model.act_fn(model.fc_embed_state_action(torch.cat([state, actions[t]], dim=1)))
+        beliefs.append(model.rnn(hidden, beliefs[t]))
+
+        hidden = model.act_fn(model.fc_embed_belief_prior(beliefs[t + 1]))
+        mean, std_dev = torch.chunk(model.fc_state_prior(hidden), 2, dim=1)
+        prior_means.append(mean)
+        prior_std_devs.append(F.softplus(std_dev) + model.min_std_dev)
+        prior_states.append(mean)
+
+        if observations is not None:
+            hidden = model.act_fn(model.fc_embed_belief_posterior(torch.cat([beliefs[t + 1], observations[t]], dim=1)))
+            mean, std_dev = torch.chunk(model.fc_state_posterior(hidden), 2, dim=1)
+            posterior_means.append(mean)
+            posterior_std_devs.append(F.softplus(std_dev) + model.min_std_dev)
+            posterior_states.append(mean)
+
+    hidden = [torch.stack(beliefs[1:]), torch.stack(prior_states[1:]), torch.stack(prior_means), torch.stack(prior_std_devs)]
+    if observations is not None:
+        hidden += [torch.stack(posterior_states[1:]), torch.stack(posterior_means), torch.stack(posterior_std_devs)]
+    return hidden
+
+
+def rollout_inputs(with_observations):
+    actions = torch.randn(T - 1, BATCH_SIZE, ACTION_SIZE)
+    prev_state, prev_belief = torch.randn(BATCH_SIZE, STATE_SIZE), torch.randn(BATCH_SIZE, BELIEF_SIZE)
+    observations = torch.randn(T - 1, BATCH_SIZE, EMBEDDING_SIZE) if with_observations else None
+    nonterminals = (torch.rand(T - 1, BATCH_SIZE, 1) > 0.3).float()
+    return prev_state, actions, prev_belief, observations, nonterminals
+
+
+def weighted_sum(outputs):
+    # a scalar that depends on every output, with a different weight per output so that swapped outputs are caught
+    return sum((output * (i + 1)).sum() for i, output in enumerate(outputs))
+
+
+def test_gru_cell():
+    torch.manual_seed(0)
+    cell = nn.GRUCell(HIDDEN_SIZE, BELIEF_SIZE)
+    input = torch.randn(BATCH_SIZE, HIDDEN_SIZE, requires_grad=True)
+    hidden = torch.randn(BATCH_SIZE, BELIEF_SIZE, requires_grad=True)
+
+    expected = cell(input, hidden)
+    expected_grads = torch.autograd.grad(expected.pow(2).sum(), [input, hidden] + list(cell.parameters()))
+    output = gru_cell(input, hidden, cell.weight_ih, cell.weight_hh, cell.bias_ih, cell.bias_hh)
+    grads = torch.autograd.grad(output.pow(2).sum(), [input, hidden] + list(cell.parameters()))
+
+    assert torch.allclose(output, expected, atol=1e-6), 'gru_cell output differs from nn.GRUCell'
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-5), 'gru_cell gradient differs from nn.GRUCell'
+
+
+def test_transition_model_matches_reference():
+    for with_observations in (True, False):
+        torch.manual_seed(0)
+        model = TransitionModel(BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE, 'elu')
+        inputs = rollout_inputs(with_observations)
+
+        expected = reference_rollout(model, *inputs)
+        expected_grads = torch.autograd.grad(weighted_sum(expected), list(model.parameters()), allow_unused=True)
+        with no_noise():
+            outputs = model(*inputs)
+        grads = torch.autograd.grad(weighted_sum(outputs), list(model.parameters()), allow_unused=True)
+
+        assert len(outputs) == len(expected), 'Number of outputs incorrect'
+        for output, expected_output in zip(outputs, expected):
+            assert output.shape == expected_output.shape, 'Shape of output incorrect'
+            assert torch.allclose(output, expected_output, atol=1e-5), 'TransitionModel differs from the reference rollout'
+        for grad, expected_grad in zip(grads, expected_grads):
+            if expected_grad is None:
+                continue
+            assert torch.allclose(grad, expected_grad, atol=1e-4), 'TransitionModel gradient differs from the reference rollout'
+
+
+def test_scripted_transition_model():
+    # the scripted module draws the same noise as the eager one for the same seed
+    for with_observations in (True, False):
+        torch.manual_seed(0)
+        model = TransitionModel(BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE, 'elu')
+        scripted_model = torch.jit.script(model)
+        inputs = rollout_inputs(with_observations)
+
+        torch.manual_seed(1)
+        expected = model(*inputs)
+        torch.manual_seed(1)
+        outputs = scripted_model(*inputs)
+
+        for output, expected_output in zip(outputs, expected):
+            assert torch.allclose(output, expected_output, atol=1e-5), 'Scripted TransitionModel differs from eager'
+
+
+def test_actor_logprob():
+    # the closed-form log-prob of the tanh-squashed Normal against torch.distributions, evaluated at the pre-tanh sample
+    torch.manual_seed(0)
+    actor = ActorModel(ACTION_SIZE, BELIEF_SIZE, STATE_SIZE, HIDDEN_SIZE, activation_function='elu')
+    belief, state = torch.randn(BATCH_SIZE, BELIEF_SIZE), torch.randn(BATCH_SIZE, STATE_SIZE)
+
+    torch.manual_seed(1)
+    action, logp_pi = actor(belief, state, with_logprob=True)
+
+    hidden = F.elu(actor.fc1(torch.cat([belief, state], dim=1)))
+    for layer in (actor.fc2, actor.fc3, actor.fc4):
+        hidden = F.elu(layer(hidden))
+    mean, std = torch.chunk(actor.fc5(hidden), 2, dim=-1)
+    mean = actor.mean_scale * torch.tanh(mean / actor.mean_scale)
+    std = F.softplus(std + math.log(math.expm1(actor.init_std))) + actor.min_std
+    torch.manual_seed(1)
+    pre_tanh_action = mean + std * torch.randn_like(mean)
+    tanh = torch.distributions.transforms.TanhTransform()
+    expected_logp_pi = (torch.distributions.Normal(mean, std).log_prob(pre_tanh_action)
+                        - tanh.log_abs_det_jacobian(pre_tanh_action, tanh(pre_tanh_action))).sum(dim=-1)
+
+    assert action.shape == (BATCH_SIZE, ACTION_SIZE), 'Shape of action incorrect'
+    assert logp_pi.shape == (BATCH_SIZE,), 'Shape of logp_pi incorrect'
+    assert torch.allclose(action, torch.tanh(pre_tanh_action), atol=1e-6), 'Actor action differs from the reference sample'
+    assert torch.allclose(logp_pi, expected_logp_pi, atol=1e-4), 'Closed-form log-prob differs from torch.distributions'
+
+
+def test_float64_outputs():
+    # the FP32 casts for autocast must not downcast a float64 model
+    torch.manual_seed(0)
+    model = TransitionModel(BELIEF_SIZE, STATE_SIZE, ACTION_SIZE, HIDDEN_SIZE, EMBEDDING_SIZE, 'elu').double()
+    for with_observations in (True, False):
+        inputs = [x.double() if x is not None else None for x in rollout_inputs(with_observations)]
+        for output in model(*inputs) + torch.jit.script(model)(*inputs):
+            assert output.dtype == torch.float64, 'TransitionModel output downcast from float64'
+
+    actor = ActorModel(ACTION_SIZE, BELIEF_SIZE, STATE_SIZE, HIDDEN_SIZE, activation_function='elu').double()
+    belief, state = torch.randn(BATCH_SIZE, BELIEF_SIZE).double(), torch.randn(BATCH_SIZE, STATE_SIZE).double()
+    for deterministic in (False, True):
+        action, logp_pi = actor(belief, state, deterministic=deterministic, with_logprob=True)
+        assert action.dtype == logp_pi.dtype == torch.float64, 'ActorModel output downcast from float64'
+
+
+def test_scalar_heads_fp32_under_autocast():
+    # rewards, values and discounts feed the lambda-returns, which must not be computed in bf16
+    torch.manual_seed(0)
+    belief, state = torch.randn(BATCH_SIZE, BELIEF_SIZE), torch.randn(BATCH_SIZE, STATE_SIZE)
+    for model in (RewardModel, ValueModel, PCONTModel):
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            output = model(BELIEF_SIZE, STATE_SIZE, HIDDEN_SIZE)(belief, state)
+        assert output.dtype == torch.float32, '{} output is not FP32 under autocast'.format(model.__name__)
+
+
+def tanh_normal(batch_shape, samples):
+    # the distribution ActorModel wraps in SampleDist, away from the saturated region where atanh is unstable
+    mean, std = 0.5 * torch.randn(batch_shape), 0.2 + 0.3 * torch.rand(batch_shape)
+    dist = torch.distributions.TransformedDistribution(torch.distributions.Normal(mean, std), torch.distributions.transforms.TanhTransform())
+    return SampleDist(torch.distributions.Independent(dist, 1), samples)
+
+
+def test_sample_dist_mode():
+    # against the original estimator: the most likely of the samples, scored with log_prob of the transformed sample
+    torch.manual_seed(0)
+    dist = tanh_normal((BATCH_SIZE, ACTION_SIZE), samples=100)
+    torch.manual_seed(1)
+    mode = dist.mode()
+    torch.manual_seed(1)
+    expanded_dist = dist._dist.expand((100, BATCH_SIZE))
+    sample = expanded_dist.rsample()
+    expected_mode = sample[torch.argmax(expanded_dist.log_prob(sample), dim=0), torch.arange(BATCH_SIZE)]
+
+    assert mode.shape == (BATCH_SIZE, ACTION_SIZE), 'Shape of mode incorrect'
+    assert torch.allclose(mode, expected_mode, atol=1e-6), 'SampleDist.mode differs from the original estimator'
+
+
+def test_sample_dist_entropy():
+    # against the original estimator -E[log_prob(sample)]; both are sampled, so they agree up to Monte Carlo error
+    torch.manual_seed(0)
+    dist = tanh_normal((BATCH_SIZE, ACTION_SIZE), samples=20000)
+    entropy = dist.entropy()
+    expanded_dist = dist._dist.expand((20000, BATCH_SIZE))
+    expected_entropy = -torch.mean(expanded_dist.log_prob(expanded_dist.rsample()), 0)
+
+    assert entropy.shape == (BATCH_SIZE,), 'Shape of entropy incorrect'
+    assert torch.allclose(entropy, expected_entropy, atol=0.05), 'SampleDist.entropy differs from the original estimator'
+
+
+def test_sample_dist_unsupported_structure():
+    dist = SampleDist(torch.distributions.Normal(torch.zeros(BATCH_SIZE, ACTION_SIZE), 1.))
+    assert dist.mean.shape == (BATCH_SIZE, ACTION_SIZE), 'Shape of mean incorrect'
+    for method in (dist.mode, dist.entropy):
+        try:
+            method()
+        except NotImplementedError:
+            continue
+        raise AssertionError('SampleDist.{} should reject a distribution it cannot handle'.format(method.__name__))
+
+
+if __name__ == '__main__':
+
+    test_gru_cell()
+    test_transition_model_matches_reference()
+    test_scripted_transition_model()
+    test_actor_logprob()
+    test_float64_outputs()
+    test_scalar_heads_fp32_under_autocast()
+    test_sample_dist_mode()
+    test_sample_dist_entropy()
+    test_sample_dist_unsupported_structure()
+    print('All tests passed')